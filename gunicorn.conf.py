@@ -0,0 +1,28 @@
+# gunicorn 設定檔（gunicorn 啟動時會自動讀取目前目錄下的 gunicorn.conf.py）
+#
+#   gunicorn main:app
+#
+# 用 gthread worker：每個 worker 有多條 thread，
+# 一則訊息在等 OpenAI / GAS 時，其他 webhook 不會被卡住。
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = "gthread"
+# ✅ 預設依 CPU 核心數開 worker（至少 2 個），平台有給 WEB_CONCURRENCY 就照平台的
+workers = int(os.environ.get("WEB_CONCURRENCY", str(max(2, multiprocessing.cpu_count()))))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# OpenAI 回覆偶爾會比較慢，避免 worker 被當成卡死砍掉
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 15
+keepalive = 5
+
+
+def post_worker_init(worker):
+    # ✅ 每個 worker 載入 app 之後先預熱 LINE API 連線（設 LINE_PREFLIGHT=0 可關閉）
+    if os.environ.get("LINE_PREFLIGHT", "1") != "1":
+        return
+    import main
+
+    main.start_line_preflight()
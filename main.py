@@ -1,14 +1,29 @@
 import os
 import logging
-from datetime import datetime, timezone
+import logging.handlers
 import json
+import time
+import atexit
+import queue
+import re
+import hashlib
+import hmac
+import base64
+import functools
+import threading
 import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, abort
+from flask.json.provider import DefaultJSONProvider
 
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent,
     TextMessage,
@@ -19,26 +34,154 @@ from linebot.models import (
     Sender,
 )
 
-# -------- OpenAI (新版 SDK) --------
+# -------- numpy（語意快取用，沒裝就只用完全比對快取） --------
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# -------- orjson（比較快的 JSON，沒裝就用內建 json） --------
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# -------- redis（多個 worker / 多台機器共用狀態，沒設 REDIS_URL 就用記憶體） --------
 try:
-    from openai import OpenAI
-    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-except Exception as e:
-    openai_client = None
-    print("OpenAI 初始化失敗，請確認 openai 套件與 OPENAI_API_KEY：", e)
+    import redis
+except ImportError:
+    redis = None
+
+# -------- OpenAI (新版 SDK) --------
+# SDK 預設 timeout 是 600 秒，對 LINE 客服來說太久了
+OPENAI_TIMEOUT_SEC = float(os.getenv("OPENAI_TIMEOUT_SEC", "30"))
+# 429 / 5xx 由 SDK 自動重試（指數退避 + jitter，會參考 Retry-After）
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+# 回覆路徑上的單次請求再壓短一點：chat completion 6 秒（串流時是每個 chunk 之間的等待上限）、
+# 只是用來查快取的 embedding 3 秒，超過就直接用備用訊息 / 跳過語意快取
+OPENAI_CHAT_TIMEOUT_SEC = float(os.getenv("OPENAI_CHAT_TIMEOUT_SEC", "6"))
+OPENAI_EMBED_TIMEOUT_SEC = float(os.getenv("OPENAI_EMBED_TIMEOUT_SEC", "3"))
+# 回覆路徑上不讓 SDK 自動重試：不然一次卡住會變成 (重試次數 + 1) × timeout + 退避，
+# 使用者要等將近 30 秒才收到備用訊息
+OPENAI_REPLY_MAX_RETRIES = int(os.getenv("OPENAI_REPLY_MAX_RETRIES", "0"))
+
+
+@functools.cache
+def get_openai_client():
+    """
+    第一次真的要用 AI 時才 import openai 並建立 client（縮短冷啟動），之後都重用同一個。
+    初始化失敗回傳 None（結果一樣會被記住，不會每則訊息重試）。
+    """
+    try:
+        from openai import OpenAI
+        return OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=OPENAI_TIMEOUT_SEC,
+            max_retries=OPENAI_MAX_RETRIES,
+        )
+    except Exception as e:
+        logging.error("OpenAI 初始化失敗，請確認 openai 套件與 OPENAI_API_KEY：%s", e)
+        return None
 
 # -------- 基本設定 --------
 app = Flask(__name__)
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask 回傳 dict / jsonify 時改用 orjson 序列化（中文不轉成 \\uXXXX）"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
 
 if not CHANNEL_SECRET or not CHANNEL_ACCESS_TOKEN:
     raise Exception("請設定 LINE_CHANNEL_SECRET 與 LINE_CHANNEL_ACCESS_TOKEN 環境變數")
 
-line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
+# webhook 驗簽用的 HMAC key，啟動時 encode 一次就好
+CHANNEL_SECRET_BYTES = CHANNEL_SECRET.encode("utf-8")
+# base64(HMAC-SHA256) 固定是 44 個字元
+LINE_SIGNATURE_LEN = 44
+# LINE webhook 一次最多幾十個事件，64KB 很夠用
+WEBHOOK_MAX_BODY_BYTES = 65536
+# 背景處理 webhook 事件的 thread 數（每個 gunicorn worker 各一組）；OpenAI 同時請求數的上限也由這個決定
+WEBHOOK_WORKERS = max(2, int(os.environ.get("WEBHOOK_WORKERS", "8")))
+
+# ✅ LINE Messaging API 也共用一個 Session（keep-alive）：
+# SDK 內建的 RequestsHttpClient 每次都用 requests.post，等於每則回覆都重新 TLS handshake
+# 只在連線失敗時重試（reply token 只能用一次，已送出的請求不能重送）
+LINE_SESSION = requests.Session()
+LINE_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=16,
+        max_retries=Retry(total=2, read=0, backoff_factor=0.2, raise_on_status=False),
+    ),
+)
+
+
+class SessionHttpClient(RequestsHttpClient):
+    """跟 RequestsHttpClient 一樣，只是改用 LINE_SESSION 送出請求"""
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = LINE_SESSION.get(
+            url, headers=headers, params=params, stream=stream,
+            timeout=self.timeout if timeout is None else timeout,
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = LINE_SESSION.post(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout,
+        )
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = LINE_SESSION.delete(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout,
+        )
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = LINE_SESSION.put(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout,
+        )
+        return RequestsHttpResponse(response)
+
+
+line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN, http_client=SessionHttpClient)
 handler = WebhookHandler(CHANNEL_SECRET)
 
+
+def _preflight_line_connection():
+    try:
+        line_bot_api.get_bot_info(timeout=5)
+        logging.info("LINE API preflight ok")
+    except Exception as e:
+        logging.warning("LINE API preflight failed: %s", e)
+
+
+def start_line_preflight():
+    """
+    先打一次 LINE API，讓 LINE_SESSION 先把 TLS 連線建好，第一則回覆就不用再等 handshake。
+    在背景 thread 執行，不拖慢啟動；由 gunicorn.conf.py 的 post_worker_init 在每個 worker 呼叫，
+    import main.py（script / REPL）時不會自動連網。
+    """
+    threading.Thread(target=_preflight_line_connection, name="line-preflight", daemon=True).start()
+
+
 # ✅ 既有：給 GAS 用的 Web App URL（exec）— routing / line log 都用這個
 GAS_LINE_LOG_URL = os.environ.get(
     "GAS_LINE_LOG_URL",
@@ -49,11 +192,111 @@ GAS_LINE_LOG_URL = os.environ.get(
 # 若你 bookingConfirmByReservationId 也寫在同一支 GAS，就不用另外設 GAS_BOOKING_URL
 GAS_BOOKING_URL = os.environ.get("GAS_BOOKING_URL", GAS_LINE_LOG_URL)
 
-logging.basicConfig(level=logging.INFO)
+# ✅ log 先丟進 queue，由背景的 QueueListener 寫到 stderr，
+# webhook / OpenAI 的 thread 不用排隊等 logging lock 跟 write syscall
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+_log_record_queue = queue.SimpleQueue()
+# basicConfig 的格式會套在 QueueHandler 上（進 queue 前就排好版），listener 端直接輸出
+_log_stream_handler = logging.StreamHandler()
+logging.basicConfig(
+    level=LOG_LEVEL,
+    handlers=[logging.handlers.QueueHandler(_log_record_queue)],
+)
+_log_listener = logging.handlers.QueueListener(_log_record_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# 除錯用：設成 1 才把整個 webhook body 用 INFO 寫進 log；
+# 平常 INFO 只記長度，body 前 200 字只在 DEBUG 等級才會輸出
+LOG_FULL_BODY = os.environ.get("LOG_FULL_BODY", "") == "1"
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# LINE 後台「Verify」webhook 時送來的假 reply_token
+INVALID_REPLY_TOKENS = frozenset(("0" * 32, "f" * 32))
+
+# 小潔回覆時顯示的名稱；SDK 只會讀它來組 JSON，所有訊息共用同一個物件
+XIAOJIE_SENDER = Sender(name="小潔 H.R 燈藝客服")
+
+# ✅ 打 GAS 共用同一個 Session（keep-alive），不用每次重新 TCP + TLS handshake
+# 502/503/504 只會對 GET（routing 查詢）自動重試；POST 只在連線失敗時重試，避免重複寫入
+GAS_SESSION = requests.Session()
+GAS_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+# ================== 共用：JSON 序列化 ==================
+
+def dumps_json_bytes(obj) -> bytes:
+    """
+    序列化成 UTF-8 JSON bytes（中文不轉成 \\uXXXX，payload 比較小）。
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def loads_json(data):
+    """
+    解析 JSON（bytes 或 str）；GAS 回應直接丟 resp.content 進來，不用先 decode 成 str。
+    格式錯誤時兩種實作都會丟 ValueError。
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 # ================== 共用：查詢 LineUsers 的 bot_mode / last_mode_at_ms ==================
 
+# ✅ routing 很少變動：同一個使用者連續傳訊息時，短時間內直接用上一次查到的結果
+# （代價是店家切換模式後，最多 ROUTING_CACHE_TTL_SEC 秒才會生效；設 0 關閉快取）
+ROUTING_CACHE_TTL_SEC = float(os.environ.get("ROUTING_CACHE_TTL_SEC", "15"))
+# 真人接手中（owner_manual / staff_manual）的使用者記久一點：
+# 頂多晚一點切回小潔，不會誤觸自動回覆
+ROUTING_MANUAL_CACHE_TTL_SEC = float(os.environ.get("ROUTING_MANUAL_CACHE_TTL_SEC", "60"))
+ROUTING_CACHE_MAX = 10000
+_routing_cache = OrderedDict()  # line_user_id -> (expires_at, (bot_mode, owner_agent_id, last_mode_at_ms))
+_routing_cache_lock = threading.Lock()
+
+
+def _get_cached_routing(line_user_id: str):
+    with _routing_cache_lock:
+        hit = _routing_cache.get(line_user_id)
+        if hit is None:
+            return None
+        if hit[0] <= time.monotonic():
+            del _routing_cache[line_user_id]
+            return None
+        return hit[1]
+
+
+def _store_cached_routing(line_user_id: str, routing: tuple):
+    ttl = ROUTING_CACHE_TTL_SEC if routing[0] == "auto_ai" else ROUTING_MANUAL_CACHE_TTL_SEC
+    if ttl <= 0:
+        return
+    with _routing_cache_lock:
+        _routing_cache[line_user_id] = (time.monotonic() + ttl, routing)
+        _routing_cache.move_to_end(line_user_id)
+        while len(_routing_cache) > ROUTING_CACHE_MAX:
+            _routing_cache.popitem(last=False)
+
+
+def invalidate_cached_routing(line_user_id: str):
+    with _routing_cache_lock:
+        _routing_cache.pop(line_user_id, None)
+
+
 def get_line_user_routing(line_user_id: str):
     """
     從 GAS 取得這個 line_user_id 的 routing 設定：
@@ -68,8 +311,12 @@ def get_line_user_routing(line_user_id: str):
     if not GAS_LINE_LOG_URL or not line_user_id:
         return default
 
+    cached = _get_cached_routing(line_user_id)
+    if cached is not None:
+        return cached
+
     try:
-        resp = requests.get(
+        resp = GAS_SESSION.get(
             GAS_LINE_LOG_URL,
             params={
                 "action": "getLineUserRouting",
@@ -78,38 +325,142 @@ def get_line_user_routing(line_user_id: str):
             timeout=5,
         )
         resp.raise_for_status()
-        data = resp.json()
-        if not isinstance(data, dict):
+        routing = _routing_from_gas_response(loads_json(resp.content))
+        if routing is None:
             return default
-        if data.get("ok") is False:
-            return default
-
-        mode = data.get("bot_mode") or "auto_ai"
-        owner = data.get("owner_agent_id") or ""
-        last_ms = data.get("last_mode_at_ms", None)
-
-        if isinstance(last_ms, (int, float)):
-            last_ms = int(last_ms)
-        else:
-            last_ms = None
-
-        if mode not in ("auto_ai", "owner_manual", "staff_manual"):
-            mode = "auto_ai"
 
         logging.info(
             "routing for %s: mode=%s owner=%s last_mode_at_ms=%s",
-            line_user_id, mode, owner, last_ms
+            line_user_id, *routing
         )
-        return mode, owner, last_ms
+        _store_cached_routing(line_user_id, routing)
+        return routing
 
     except Exception as e:
         logging.error("get_line_user_routing error: %s", e)
         return default
 
 
-def should_auto_reply_text(bot_mode: str, event_timestamp_ms, last_mode_at_ms) -> bool:
+def _routing_from_gas_response(data):
+    """
+    GAS 回傳的 JSON → (bot_mode, owner_agent_id, last_mode_at_ms)；
+    格式不對或 ok=false 回傳 None。
+    """
+    if not isinstance(data, dict) or data.get("ok") is False:
+        return None
+
+    mode = data.get("bot_mode") or "auto_ai"
+    owner = data.get("owner_agent_id") or ""
+    last_ms = data.get("last_mode_at_ms", None)
+
+    if isinstance(last_ms, (int, float)):
+        last_ms = int(last_ms)
+    else:
+        last_ms = None
+
+    if mode not in ("auto_ai", "owner_manual", "staff_manual"):
+        mode = "auto_ai"
+
+    return mode, owner, last_ms
+
+
+# ✅ 設成 1：routing 沒有快取時，改打 GAS 的 processTextTurn，
+# 一次 POST 同時寫入「使用者這句話」並取回 routing（省掉一次 GAS 來回）。
+# Code.gs 要有對應的 action；GAS 沒回 logged=true 時會自動退回 log queue + getLineUserRouting
+GAS_PROCESS_TEXT_TURN = os.environ.get("GAS_PROCESS_TEXT_TURN", "") == "1"
+
+
+def process_text_turn(line_user_id: str, user_log_body: dict, event_timestamp_ms=None):
+    """
+    呼叫 GAS：processTextTurn
+      送出 { action: 'processTextTurn', body: { line_user_id, user_msg_body, event_timestamp_ms } }
+      預期回傳 { ok: true, logged: true, bot_mode, owner_agent_id, last_mode_at_ms }
+
+    回傳 (bot_mode, owner_agent_id, last_mode_at_ms)；
+    GAS 有回應、但明確沒有寫入使用者訊息（或根本沒連上）時回傳 None，由呼叫端照舊處理。
+    讀取逾時這類不確定 GAS 有沒有寫入的情況，不回傳 None（避免同一則訊息被寫兩次），
+    直接用預設 routing，也省掉再查一次 getLineUserRouting 的時間。
+    """
+    payload = {
+        "action": "processTextTurn",
+        "body": {
+            "line_user_id": line_user_id,
+            "user_msg_body": user_log_body,
+            "event_timestamp_ms": event_timestamp_ms,
+        },
+    }
+    try:
+        resp = GAS_SESSION.post(
+            GAS_LINE_LOG_URL,
+            data=dumps_json_bytes(payload),
+            headers=JSON_HEADERS,
+            timeout=5,
+        )
+    except requests.exceptions.ConnectTimeout as e:
+        # 連線都沒建立起來，GAS 一定沒寫入 → 交給呼叫端照舊處理
+        logging.error("process_text_turn connect error: %s", e)
+        return None
+    except Exception as e:
+        logging.error("process_text_turn error, user log not retried: %s", e)
+        return ("auto_ai", "", None)
+
+    try:
+        data = loads_json(resp.content) if resp.ok else None
+    except ValueError:
+        data = None
+
+    if not isinstance(data, dict) or data.get("logged") is not True:
+        return None
+
+    _mark_event_logged(user_log_body.get("event_id", ""))
+    routing = _routing_from_gas_response(data)
+    if routing is None:
+        # 訊息已經寫進去了，只是 routing 讀不到 → 用預設值，不放進快取
+        return ("auto_ai", "", None)
+
+    logging.info(
+        "routing for %s (processTextTurn): mode=%s owner=%s last_mode_at_ms=%s",
+        line_user_id, *routing
+    )
+    _store_cached_routing(line_user_id, routing)
+    return routing
+
+
+def get_routing_for_turn(line_user_id: str, user_log_body=None, event_timestamp_ms=None):
+    """
+    查 routing，順便處理還沒寫進 GAS 的使用者訊息（user_log_body，None 代表已經處理過）：
+    能合併就用 processTextTurn 一次送出，不然就丟進 log queue 再照舊查 routing。
+    """
+    if (
+        user_log_body is not None
+        and GAS_PROCESS_TEXT_TURN
+        and GAS_LINE_LOG_URL
+        and line_user_id
+        and _get_cached_routing(line_user_id) is None
+    ):
+        routing = process_text_turn(line_user_id, user_log_body, event_timestamp_ms)
+        if routing is not None:
+            return routing
+
+    if user_log_body is not None:
+        log_to_gas(user_log_body)
+    return get_line_user_routing(line_user_id)
+
+
+# 事件送達超過這個時間（毫秒）就不自動回覆：避免 LINE 很久以後才重送的舊訊息突然被回
+# 原本寫死 10 秒，冷啟動或 OpenAI 慢一點時正常訊息也會被丟掉，所以放寬到 120 秒
+EVENT_FRESHNESS_MS = int(os.getenv("EVENT_FRESHNESS_MS", "120000"))
+
+
+def current_ms() -> int:
+    # 現在時間（epoch 毫秒），不建立 datetime 物件
+    return time.time_ns() // 1_000_000
+
+
+def should_auto_reply_text(bot_mode: str, event_timestamp_ms, last_mode_at_ms, now_ms=None) -> bool:
     """
     決定這一則文字事件，是否要由小潔自動回覆。
+    now_ms：呼叫端已經取過現在時間（毫秒）就直接傳進來
     """
     if bot_mode != "auto_ai":
         return False
@@ -117,11 +468,12 @@ def should_auto_reply_text(bot_mode: str, event_timestamp_ms, last_mode_at_ms) -
     if not isinstance(event_timestamp_ms, (int, float)):
         return False
 
-    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    if now_ms is None:
+        now_ms = current_ms()
     delta_ms = now_ms - int(event_timestamp_ms)
 
-    # 超過 10 秒就視為舊事件，不自動回覆
-    if delta_ms > 10 * 1000:
+    # 超過 EVENT_FRESHNESS_MS 就視為舊事件，不自動回覆
+    if delta_ms > EVENT_FRESHNESS_MS:
         logging.info(
             "event too old to auto-reply: delta_ms=%s (mode=%s)", delta_ms, bot_mode
         )
@@ -139,30 +491,293 @@ def should_auto_reply_text(bot_mode: str, event_timestamp_ms, last_mode_at_ms) -
     return True
 
 
+# ================== 共用狀態：本機用記憶體，正式環境用 Redis ==================
+
+class InMemoryBackend:
+    """
+    process 內的 key-value（字串，附 TTL），本機開發或只跑一個 worker 時用。
+    超過 max_items 就丟掉最舊的。
+    """
+
+    def __init__(self, max_items: int = 4096):
+        self.max_items = max_items
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            if hit[0] <= time.monotonic():
+                del self._data[key]
+                return None
+            return hit[1]
+
+    def set(self, key: str, value: str, ex: int):
+        with self._lock:
+            self._put(key, value, ex)
+
+    def set_if_absent(self, key: str, value: str, ex: int) -> bool:
+        """key 不存在（或已過期）才寫入，回傳有沒有寫入"""
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is not None and hit[0] > time.monotonic():
+                return False
+            self._put(key, value, ex)
+            return True
+
+    def _put(self, key: str, value: str, ex: int):
+        # 呼叫端要先拿到 self._lock
+        self._data[key] = (time.monotonic() + ex, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_items:
+            self._data.popitem(last=False)
+
+
+class RedisBackend:
+    """
+    跟 InMemoryBackend 同樣的介面，多個 gunicorn worker / 多台機器共用。
+    Redis 暫時連不到時不擋訊息處理：get 當作沒有、set 只記 log。
+    """
+
+    def __init__(self, url: str):
+        self._redis = redis.Redis.from_url(url, decode_responses=True, socket_timeout=1)
+
+    def get(self, key: str):
+        try:
+            return self._redis.get(key)
+        except Exception as e:
+            logging.error("redis get error: %s", e)
+            return None
+
+    def set(self, key: str, value: str, ex: int):
+        try:
+            self._redis.set(key, value, ex=ex)
+        except Exception as e:
+            logging.error("redis set error: %s", e)
+
+    def set_if_absent(self, key: str, value: str, ex: int) -> bool:
+        try:
+            return bool(self._redis.set(key, value, ex=ex, nx=True))
+        except Exception as e:
+            logging.error("redis set nx error: %s", e)
+            return True
+
+
+# 每則訊息大約會用到 3 個 key（seen + user / bot 兩筆 logged）
+STATE_MEMORY_MAX_ITEMS = 50000
+
+
+def _make_state_backend():
+    redis_url = os.environ.get("REDIS_URL", "")
+    if not redis_url:
+        return InMemoryBackend(STATE_MEMORY_MAX_ITEMS)
+    if redis is None:
+        logging.error("REDIS_URL 有設定但沒有安裝 redis 套件，改用記憶體")
+        return InMemoryBackend(STATE_MEMORY_MAX_ITEMS)
+    return RedisBackend(redis_url)
+
+
+state_backend = _make_state_backend()
+
+
+# ✅ LINE 重送 webhook 時整則略過，不再重複打 GAS / OpenAI
+# 訊息用 message.id；postback 沒有 message，改用 LINE 給的 webhookEventId（重送時不會變）
+SEEN_EVENT_TTL_SEC = 600
+
+
+def is_redelivered_event(event) -> bool:
+    message = getattr(event, "message", None)
+    if message is not None and getattr(message, "id", ""):
+        key = f"seen:{message.id}"
+    elif getattr(event, "webhook_event_id", ""):
+        key = f"seen:evt:{event.webhook_event_id}"
+    else:
+        return False
+    if state_backend.set_if_absent(key, "1", ex=SEEN_EVENT_TTL_SEC):
+        return False
+    logging.info("event already handled, skip: %s", key)
+    return True
+
+
 # ================== 共用：把訊息記錄到 GAS（line_messages） ==================
 
+# ✅ 已經成功寫進 GAS 的 event_id（LINE 重送 webhook 時就不用再 POST 一次）
+# 記在 state_backend，有 Redis 的話換到別的 worker 重送也認得出來
+LOGGED_EVENT_TTL_SEC = 24 * 60 * 60
+
+
+def _is_event_logged(event_id: str) -> bool:
+    if not event_id:
+        return False
+    return state_backend.get(f"logged:{event_id}") is not None
+
+
+def _mark_event_logged(event_id: str):
+    if not event_id:
+        return
+    state_backend.set(f"logged:{event_id}", "1", ex=LOGGED_EVENT_TTL_SEC)
+
+
+# ✅ log 先丟進 queue，由背景 thread 每 0.5 秒或累積 20 筆合併成一次 POST
+LOG_BATCH_MAX = 20
+LOG_FLUSH_INTERVAL_SEC = 0.5
+# GAS 掛掉時 queue 不會無限長大：滿了就丟掉新的 log（記 warning），不影響回覆
+LOG_QUEUE_MAX = 10000
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_LOG_STOP = object()
+
+
 def log_to_gas(body: dict):
     """
-    把 body 打給 GAS 的 doPost。
-    使用 { action: 'lineLog', body: {...} } 格式，
-    對應 Code.gs 裡的 appLineLog。
+    把 body 交給背景 thread 打給 GAS 的 doPost（fire-and-forget，呼叫端立即返回）。
+    單筆使用 { action: 'lineLog', body: {...} }，對應 Code.gs 裡的 appLineLog；
+    多筆合併成 { action: 'lineLogBatch', body: { items: [...] } }。
     """
     if not GAS_LINE_LOG_URL:
         logging.warning("GAS_LINE_LOG_URL 未設定，略過記錄 log")
         return
 
+    try:
+        _log_queue.put_nowait(body)
+    except queue.Full:
+        logging.warning("log queue full, drop log: %s", body.get("event_id", ""))
+
+
+def _log_flush_loop():
+    while True:
+        item = _log_queue.get()
+        if item is _LOG_STOP:
+            return
+
+        batch = [item]
+        stop = False
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL_SEC
+        while len(batch) < LOG_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _log_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _LOG_STOP:
+                stop = True
+                break
+            batch.append(item)
+
+        _post_log_batch_to_gas(batch)
+        if stop:
+            return
+
+
+def _post_log_batch_to_gas(batch: list):
+    if len(batch) == 1:
+        _post_log_to_gas(batch[0])
+        return
+
+    payload = {
+        "action": "lineLogBatch",
+        "body": {"items": batch},
+    }
+    try:
+        resp = GAS_SESSION.post(
+            GAS_LINE_LOG_URL,
+            data=dumps_json_bytes(payload),
+            headers=JSON_HEADERS,
+            timeout=8,
+        )
+    except requests.exceptions.ConnectTimeout as e:
+        # 連線都沒建立起來，GAS 一定沒寫入 → 下面一筆一筆重送是安全的
+        logging.error("log_batch_to_gas connect error: %s", e)
+    except Exception as e:
+        # 讀取逾時等情況：GAS 可能已經整批寫進去了，再一筆一筆重送會變成重複資料，只記錄不重送
+        logging.error("log_batch_to_gas error, %d logs not retried: %s", len(batch), e)
+        return
+    else:
+        logging.info("log_batch_to_gas (%d) resp: %s", len(batch), resp.text[:200])
+        try:
+            data = loads_json(resp.content) if resp.ok else None
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and data.get("ok") is True:
+            for body in batch:
+                _mark_event_logged(body.get("event_id", ""))
+            return
+
+    # GAS 明確回覆失敗（還沒支援 lineLogBatch、404、ok=false…）→ 退回一筆一筆寫
+    for body in batch:
+        _post_log_to_gas(body)
+
+
+def _flush_logs_at_exit():
+    # queue 滿的時候要等背景 thread 騰出位置，最多等 10 秒就放棄
+    deadline = time.monotonic() + 10
+    try:
+        _log_queue.put(_LOG_STOP, timeout=10)
+    except queue.Full:
+        logging.warning("log queue still full at exit, %d logs dropped", _log_queue.qsize())
+        return
+    _log_flush_thread.join(timeout=max(0.0, deadline - time.monotonic()))
+
+
+_log_flush_thread = threading.Thread(target=_log_flush_loop, name="gas-log-flush", daemon=True)
+_log_flush_thread.start()
+atexit.register(_flush_logs_at_exit)
+
+
+def _post_log_to_gas(body: dict):
     try:
         payload = {
             "action": "lineLog",
             "body": body,
         }
-        resp = requests.post(GAS_LINE_LOG_URL, json=payload, timeout=5)
+        resp = GAS_SESSION.post(
+            GAS_LINE_LOG_URL,
+            data=dumps_json_bytes(payload),
+            headers=JSON_HEADERS,
+            timeout=5,
+        )
         logging.info("log_to_gas resp: %s", resp.text[:200])
+        # 只有成功才記住，失敗的下次重送還是會再寫一次
+        if resp.ok:
+            _mark_event_logged(body.get("event_id", ""))
     except Exception as e:
         logging.error("log_to_gas error: %s", e)
 
 
-def log_from_event(
+def iso_from_ms(ms) -> str:
+    """
+    毫秒 epoch → ISO8601（UTC，毫秒精度），例如 2024-05-01T08:30:00.123+00:00。
+    直接用 time.gmtime + 整數運算，不建立 datetime 物件。
+    """
+    sec, msec = divmod(int(ms), 1000)
+    tm = time.gmtime(sec)
+    return (
+        f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}"
+        f"T{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}.{msec:03d}+00:00"
+    )
+
+
+def event_ts_iso(event) -> str:
+    # timestamp（LINE 給的是毫秒）
+    try:
+        return iso_from_ms(event.timestamp)
+    except Exception:
+        return iso_from_ms(current_ms())
+
+
+def log_from_event(event, msg_type: str, **kwargs):
+    """
+    把 LINE 的事件記錄到 GAS（參數同 build_log_body）；已經記錄過的事件直接略過。
+    """
+    body = build_log_body(event, msg_type, **kwargs)
+    if body is not None:
+        log_to_gas(body)
+
+
+def build_log_body(
     event,
     msg_type: str,
     text: str = "",
@@ -171,40 +786,33 @@ def log_from_event(
     sender: str = "user",
     display_persona=None,
     sent_by_agent_id=None,
+    ts_iso=None,
 ):
     """
-    統一把 LINE 的事件轉成 appLineLog 需要的 JSON 格式。
+    統一把 LINE 的事件轉成 appLineLog 需要的 JSON 格式；這個事件已經記錄過就回傳 None。
+    ts_iso：同一個事件要記多筆（user + bot）時，呼叫端先算好傳進來，不用每筆重算。
     """
-    # user id
-    try:
-        user_id = event.source.user_id
-    except Exception:
-        user_id = ""
-
+    # linebot 的 Source / MessageEvent 一定有這兩個屬性，不需要再包 try/except
+    user_id = event.source.user_id or ""
     # LINE 的 message.id：同一則訊息固定不變
-    try:
-        message_id = getattr(event.message, "id", "")
-    except Exception:
-        message_id = ""
+    message_id = getattr(event.message, "id", "")
 
     # 同一個事件：user / bot / agent 用不同後綴，避免重複
     event_id = f"{message_id}:{sender}" if message_id else ""
+    if _is_event_logged(event_id):
+        logging.info("event already logged, skip: %s", event_id)
+        return None
 
-    # timestamp（LINE 給的是毫秒）
-    try:
-        ts_iso = datetime.fromtimestamp(
-            event.timestamp / 1000, tz=timezone.utc
-        ).isoformat()
-    except Exception:
-        ts_iso = datetime.now(timezone.utc).isoformat()
+    if ts_iso is None:
+        ts_iso = event_ts_iso(event)
 
     body = {
         "event_id": event_id,
         "line_user_id": user_id,
         "type": msg_type,  # 'text' or 'sticker'
         "text": text,
-        "sticker_package_id": str(sticker_package_id) if sticker_package_id else "",
-        "sticker_id": str(sticker_id) if sticker_id else "",
+        "sticker_package_id": sticker_package_id or "",
+        "sticker_id": sticker_id or "",
         "sender": sender,   # 'user' / 'bot' / 'agent'
         "timestamp": ts_iso,
     }
@@ -215,7 +823,7 @@ def log_from_event(
     if sent_by_agent_id:
         body["sent_by_agent_id"] = sent_by_agent_id
 
-    log_to_gas(body)
+    return body
 
 
 def log_postback_event(line_user_id: str, data: str, sender: str = "user"):
@@ -223,44 +831,498 @@ def log_postback_event(line_user_id: str, data: str, sender: str = "user"):
     記錄 postback（不一定每個專案都要，但建議留一筆可追查）
     """
     try:
-        ts_iso = datetime.now(timezone.utc).isoformat()
+        # 現在時間只取一次：event_id 跟 timestamp 用同一個毫秒值
+        ms = current_ms()
         body = {
-            "event_id": f"postback:{int(datetime.now(timezone.utc).timestamp()*1000)}:{sender}",
+            "event_id": f"postback:{ms}:{sender}",
             "line_user_id": line_user_id or "",
             "type": "postback",
             "text": data or "",
             "sender": sender,
-            "timestamp": ts_iso,
+            "timestamp": iso_from_ms(ms),
         }
         log_to_gas(body)
     except Exception as e:
         logging.error("log_postback_event error: %s", e)
 
 
+# ================== OpenAI：小潔的 system prompt ==================
+#
+# ⚠️ 這段內容必須「每次呼叫都一模一樣」：
+#   OpenAI 的 prompt caching 只對超過約 1,024 tokens、且開頭完全相同的 prefix 生效，
+#   所以這裡刻意放了完整的店家說明，而且絕對不要用 f-string 塞 user_id 等個人資料進來。
+#   之後如果要帶使用者專屬資訊，請放在 system 之後另外一則 message。
+#   要改內容請另外新增 SYSTEM_PROMPT_V2 再把 SYSTEM_PROMPT 指過去，方便對照 log 裡的快取命中率。
+
+SYSTEM_PROMPT_V1 = (
+    "你是機車精品改裝店「H.R 燈藝」的線上客服「小潔」，"
+    "使用者多半是來詢問尾燈、方向燈、排氣管、烤漆、安裝預約等問題。\n"
+    "請用「活潑親切但專業」的口吻回覆，使用繁體中文，不要使用 emoji。\n"
+    "如果對方問到價格或施工時間，可以先提供大概區間，"
+    "並主動詢問車種與想要改裝的項目，讓你再幫忙抓比較準的估價。\n"
+    "\n"
+    "【關於 H.R 燈藝】\n"
+    "H.R 燈藝是專做機車燈具與外觀改裝的精品店，主要服務項目如下：\n"
+    "1. 尾燈：整顆尾燈總成更換、LED 導光尾燈、燻黑或透明燈殼、跑馬或呼吸燈效果。\n"
+    "2. 方向燈：前後方向燈更換、序列式（流水）方向燈、整合式方向燈、閃爍器調整。\n"
+    "3. 大燈與小燈：魚眼大燈、LED 大燈燈泡、日行燈、定位小燈、燈眉。\n"
+    "4. 排氣管：全段或尾段排氣管、隔熱護片、安裝與基本調校建議。\n"
+    "5. 烤漆：車殼局部或全車烤漆、改色、消光處理、卡夢水轉印、噴砂與修補。\n"
+    "6. 安裝與預約：以上項目都可以預約到店施工，也可以只做諮詢或估價。\n"
+    "\n"
+    "【回覆格式】\n"
+    "- LINE 的畫面很小，每次回覆盡量控制在三到六行，段落之間用換行隔開。\n"
+    "- 不要使用 Markdown 語法（例如 #、**、表格），也不要使用 emoji。\n"
+    "- 一次只問一到兩個問題，不要把客人淹沒在一長串問題裡。\n"
+    "- 稱呼客人用「您」，語氣親切但不油膩，可以適度用「～」讓語氣柔和。\n"
+    "- 如果客人只是打招呼，簡短回應並詢問想了解哪個項目就好。\n"
+    "\n"
+    "【估價時要問的資訊】\n"
+    "估價或判斷能不能裝之前，通常需要知道：\n"
+    "1. 車廠與車型，以及年份或第幾代（同一車型不同年份的燈具規格常常不同）。\n"
+    "2. 想改的項目與想要的效果，例如想要比較亮、比較有特色，或只是原廠故障要換。\n"
+    "3. 是否已經有自己準備的零件，還是需要店裡代訂或推薦。\n"
+    "4. 車子目前有沒有其他改裝，尤其是電系相關（例如已經換過 LED 或加裝其他配備）。\n"
+    "如果客人願意，可以請他傳車子目前的照片，讓師傅看過再報比較準的價格。\n"
+    "\n"
+    "【價格與施工時間】\n"
+    "- 可以給大概區間，但一定要說明「實際價格會依車型、零件與施工難度而定，以現場報價為準」。\n"
+    "- 不要報出精確到個位數的價格，也不要承諾折扣、贈品或優惠活動，這些都請客人直接跟店家確認。\n"
+    "- 施工時間同樣只能說大概，並提醒如果零件需要調貨，時間會再往後延。\n"
+    "- 烤漆類的施工通常需要比較長的時間（包含乾燥），可以提醒客人預留時間或先把車留在店裡。\n"
+    "\n"
+    "【預約流程】\n"
+    "- 客人想預約時，請他提供：想要的日期與時段、車型、想做的項目、聯絡電話與稱呼。\n"
+    "- 你無法直接幫客人完成預約或查詢預約狀態，請告訴客人「我幫您轉給店家確認時段，稍後會有專人回覆」。\n"
+    "- 預約成立後，系統會傳一則有「預約編號」的確認訊息，客人按下確認按鈕即可，不需要另外回覆。\n"
+    "- 客人要改期或取消時，請他直接留言告訴我們預約編號與新的時間，店家會再跟他確認。\n"
+    "\n"
+    "【法規與安全】\n"
+    "- 燈具改裝需要符合交通法規與驗車規定，例如顏色、亮度、位置與是否有安全認證。\n"
+    "- 客人問到「這樣改會不會被開單」或「能不能過驗車」時，提醒他會依實際改裝內容而定，"
+    "建議選擇有合格認證的產品，施工前也可以跟師傅討論。\n"
+    "- 不要教客人規避檢驗，也不要保證任何改裝「一定合法」或「一定不會被開單」。\n"
+    "- 排氣管要提醒噪音與排放相關規定，建議選擇合法認證的產品。\n"
+    "- 如果客人描述的狀況聽起來跟安全有關（例如剎車燈不亮、方向燈不閃、電線冒煙或有燒焦味），"
+    "請提醒他先停止騎乘並盡快到店或到附近車行檢查。\n"
+    "\n"
+    "【不知道答案時】\n"
+    "- 店家的營業時間、地址、電話、目前的庫存與活動內容，如果你不確定，"
+    "不要自己編，請說「這部分我幫您跟店家確認，稍後回覆您」。\n"
+    "- 遇到客訴、保固、退換貨、施工後的問題，先表達理解與抱歉，"
+    "請客人提供車型、施工日期與問題描述（可以附照片），並告訴他會轉給店長處理。\n"
+    "- 客人的問題跟機車改裝完全無關時，可以簡短友善地回應，再把話題帶回店裡的服務。\n"
+    "\n"
+    "【常見情境範例】\n"
+    "- 客人問「尾燈多少錢」：先說明價格會依車型與款式不同，給一個大概區間，"
+    "再請他提供車型與想要的效果。\n"
+    "- 客人問「可以今天去裝嗎」：說明需要先確認師傅的時段與零件是否有現貨，"
+    "請他留下車型、項目與方便的時間，會幫他轉給店家確認。\n"
+    "- 客人傳照片問「這個是什麼問題」：如果看不出來，就請他描述狀況並建議到店檢查，不要亂猜。\n"
+    "- 客人問「你是真人嗎」：可以說你是 H.R 燈藝的線上小幫手小潔，"
+    "複雜的問題會再請店裡的夥伴接手。\n"
+    "\n"
+    "【其他原則】\n"
+    "- 不要提供其他店家的比較或評價，也不要批評其他品牌或產品。\n"
+    "- 不要向客人索取身分證字號、信用卡號碼等敏感個資，預約只需要稱呼與電話。\n"
+    "- 不要承諾任何你無法確認的事情，寧可說要幫客人確認，也不要給錯誤資訊。\n"
+    "- 每次回覆結尾，如果適合，可以用一句話詢問客人還有什麼想了解的，但不要每一句都這樣收尾。"
+)
+
+SYSTEM_PROMPT = SYSTEM_PROMPT_V1
+
+# ✅ system message 只建一次，每次呼叫直接重用同一個 dict
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+# ================== OpenAI：回覆快取（完全比對 LRU + 語意相似） ==================
+
+EXACT_REPLY_CACHE_SIZE = 4096
+SEMANTIC_CACHE_SIZE = 512
+# 店家資訊偶爾會更新，快取的回覆最多沿用 6 小時
+REPLY_CACHE_TTL_SEC = 6 * 60 * 60
+EMBEDDING_MODEL = "text-embedding-3-small"
+# 0 代表關閉語意快取
+SEMANTIC_CACHE_MIN_SIM = float(os.environ.get("SEMANTIC_CACHE_MIN_SIM", "0.93"))
+# 有設路徑的話，關機時把語意快取存成 .npz，下次啟動再載回來
+# （多個 worker 會各自寫入同一個檔案，以最後關掉的那個為準）
+SEMANTIC_CACHE_PATH = os.environ.get("SEMANTIC_CACHE_PATH", "")
+
+_reply_cache_lock = threading.Lock()
+_exact_reply_cache = OrderedDict()   # key -> (expires_at, reply)
+_semantic_matrix = None              # (SEMANTIC_CACHE_SIZE, dim)，每列是單位向量
+_semantic_replies = []               # 跟 _semantic_matrix 的列一一對應
+_semantic_expires = []               # 每列的到期時間（epoch 秒）
+_semantic_next = 0                   # 環狀寫入位置
+
+# 超過這個長度（字元）的訊息不查也不存回覆快取
+REPLY_CACHE_MAX_TEXT_LEN = 40
+
+# 命中率統計：每 REPLY_CACHE_STATS_EVERY 次查詢記一行 log
+REPLY_CACHE_STATS_EVERY = 100
+_reply_cache_stats = {"exact": 0, "semantic": 0, "miss": 0}
+
+
+def _normalize_user_text(user_text: str) -> str:
+    # 「你好」「 你好 」「你好\n」視為同一句；英文不分大小寫
+    return " ".join(user_text.split()).lower()
+
+
+def _reply_cache_key(system_prompt: str, user_text: str) -> str:
+    raw = (system_prompt + "\x00" + _normalize_user_text(user_text)).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _get_exact_cached_reply(key: str):
+    with _reply_cache_lock:
+        hit = _exact_reply_cache.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= time.time():
+            del _exact_reply_cache[key]
+            return None
+        _exact_reply_cache.move_to_end(key)
+        return hit[1]
+
+
+def _embed_text(text: str):
+    """
+    取得 text 的 embedding（已正規化成單位向量）；
+    沒有 numpy / 語意快取關閉 / 呼叫失敗時回傳 None。
+    """
+    if np is None or SEMANTIC_CACHE_MIN_SIM <= 0:
+        return None
+    client = get_openai_client()
+    if client is None:
+        return None
+    try:
+        resp = client.with_options(max_retries=OPENAI_REPLY_MAX_RETRIES).embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=text,
+            timeout=OPENAI_EMBED_TIMEOUT_SEC,
+        )
+        vec = np.asarray(resp.data[0].embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else None
+    except Exception as e:
+        logging.error("OpenAI embedding 失敗: %s", e)
+        return None
+
+
+def _get_similar_cached_reply(embedding):
+    if embedding is None:
+        return None
+    with _reply_cache_lock:
+        if _semantic_matrix is None or not _semantic_replies:
+            return None
+        n = len(_semantic_replies)
+        sims = _semantic_matrix[:n] @ embedding
+        sims[np.asarray(_semantic_expires) <= time.time()] = -1.0
+        best = int(sims.argmax())
+        if float(sims[best]) >= SEMANTIC_CACHE_MIN_SIM:
+            logging.info("semantic reply cache hit: sim=%.3f", float(sims[best]))
+            return _semantic_replies[best]
+    return None
+
+
+def _store_cached_reply(key: str, embedding, reply: str):
+    global _semantic_matrix, _semantic_next
+    expires_at = time.time() + REPLY_CACHE_TTL_SEC
+    with _reply_cache_lock:
+        _exact_reply_cache[key] = (expires_at, reply)
+        _exact_reply_cache.move_to_end(key)
+        while len(_exact_reply_cache) > EXACT_REPLY_CACHE_SIZE:
+            _exact_reply_cache.popitem(last=False)
+
+        if embedding is None:
+            return
+        if _semantic_matrix is None or _semantic_matrix.shape[1] != embedding.shape[0]:
+            _semantic_matrix = np.zeros((SEMANTIC_CACHE_SIZE, embedding.shape[0]), dtype=np.float32)
+            _semantic_replies.clear()
+            _semantic_expires.clear()
+            _semantic_next = 0
+        _semantic_matrix[_semantic_next] = embedding
+        if _semantic_next < len(_semantic_replies):
+            _semantic_replies[_semantic_next] = reply
+            _semantic_expires[_semantic_next] = expires_at
+        else:
+            _semantic_replies.append(reply)
+            _semantic_expires.append(expires_at)
+        _semantic_next = (_semantic_next + 1) % SEMANTIC_CACHE_SIZE
+
+
+def _count_reply_cache(kind: str):
+    """kind：exact / semantic / miss"""
+    with _reply_cache_lock:
+        _reply_cache_stats[kind] += 1
+        total = sum(_reply_cache_stats.values())
+        if total % REPLY_CACHE_STATS_EVERY:
+            return
+        stats = dict(_reply_cache_stats)
+        size = len(_exact_reply_cache)
+    logging.info(
+        "reply cache stats: total=%d exact=%d semantic=%d miss=%d size=%d",
+        total, stats["exact"], stats["semantic"], stats["miss"], size,
+    )
+
+
+def _semantic_cache_version() -> str:
+    # system prompt 或 embedding 模型換了，舊的快取檔就不能用
+    return _reply_cache_key(SYSTEM_PROMPT, EMBEDDING_MODEL)
+
+
+def _load_semantic_cache():
+    global _semantic_matrix, _semantic_next
+    if np is None or not SEMANTIC_CACHE_PATH or not os.path.exists(SEMANTIC_CACHE_PATH):
+        return
+    try:
+        with np.load(SEMANTIC_CACHE_PATH, allow_pickle=False) as data:
+            if str(data["version"]) != _semantic_cache_version():
+                logging.info("semantic cache file is outdated, ignore: %s", SEMANTIC_CACHE_PATH)
+                return
+            matrix = data["matrix"].astype(np.float32)
+            replies = [str(r) for r in data["replies"]]
+            expires = [float(t) for t in data["expires"]]
+    except Exception as e:
+        logging.error("load semantic cache error: %s", e)
+        return
+
+    # 檔案裡是由舊到新排好的，過期的丟掉，只留最新的 SEMANTIC_CACHE_SIZE 筆
+    now = time.time()
+    keep = [i for i, t in enumerate(expires) if t > now][-SEMANTIC_CACHE_SIZE:]
+    if not keep:
+        return
+    with _reply_cache_lock:
+        _semantic_matrix = np.zeros((SEMANTIC_CACHE_SIZE, matrix.shape[1]), dtype=np.float32)
+        _semantic_matrix[: len(keep)] = matrix[keep]
+        _semantic_replies[:] = [replies[i] for i in keep]
+        _semantic_expires[:] = [expires[i] for i in keep]
+        _semantic_next = len(keep) % SEMANTIC_CACHE_SIZE
+    logging.info("semantic cache loaded: %d entries", len(keep))
+
+
+def _save_semantic_cache():
+    if np is None or not SEMANTIC_CACHE_PATH:
+        return
+    with _reply_cache_lock:
+        if _semantic_matrix is None or not _semantic_replies:
+            return
+        n = len(_semantic_replies)
+        # 環狀寫滿之後，最舊的一筆在 _semantic_next，先轉成由舊到新的順序再存
+        order = np.roll(np.arange(n), -_semantic_next) if n == SEMANTIC_CACHE_SIZE else np.arange(n)
+        matrix = _semantic_matrix[order]
+        replies = np.array([_semantic_replies[i] for i in order])
+        expires = np.array([_semantic_expires[i] for i in order], dtype=np.float64)
+
+    tmp_path = f"{SEMANTIC_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=np.array(_semantic_cache_version()),
+                matrix=matrix,
+                replies=replies,
+                expires=expires,
+            )
+        os.replace(tmp_path, SEMANTIC_CACHE_PATH)
+        logging.info("semantic cache saved: %d entries", n)
+    except Exception as e:
+        logging.error("save semantic cache error: %s", e)
+
+
+_load_semantic_cache()
+atexit.register(_save_semantic_cache)
+
+
 # ================== OpenAI：產生小潔回覆 ==================
 
-def generate_reply_from_openai(user_text: str, user_id: str = "") -> str:
-    if not openai_client:
-        return "目前暫時無法連線到 AI 伺服器，不好意思 >_<"
+# 設成 1：OpenAI 邊產生，小潔邊用 push_message 把前面完成的句子先送出，
+# 最後一段仍用 reply_message（push 會算進 LINE 訊息額度，所以預設關閉）
+STREAM_PUSH_REPLY = os.environ.get("STREAM_PUSH_REPLY", "") == "1"
+_SENTENCE_ENDS = "。！？!?\n"
+
+# 同一個 process 同時打 OpenAI 的上限，避免爆量時一起撞到 rate limit
+# 一定要比 WEBHOOK_WORKERS 小才有作用（預設少 2 條）：事件都在 _webhook_executor 上跑，
+# 設得比 thread 數大的話永遠不會擋到任何請求
+OPENAI_MAX_CONCURRENCY = max(1, min(
+    int(os.environ.get("OPENAI_MAX_CONCURRENCY", str(WEBHOOK_WORKERS - 2))),
+    WEBHOOK_WORKERS - 1,
+))
+_openai_semaphore = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
 
-    system_prompt = (
-        "你是機車精品改裝店「H.R 燈藝」的線上客服「小潔」，"
-        "使用者多半是來詢問尾燈、方向燈、排氣管、烤漆、安裝預約等問題。\n"
-        "請用「活潑親切但專業」的口吻回覆，使用繁體中文，不要使用 emoji。\n"
-        "如果對方問到價格或施工時間，可以先提供大概區間，"
-        "並主動詢問車種與想要改裝的項目，讓你再幫忙抓比較準的估價。"
+
+class TokenBucket:
+    """
+    thread-safe token bucket：每秒補 rate 個 token，最多累積 capacity 個。
+    用來把每分鐘的請求數壓在帳號的 RPM 額度以內。
+    """
+
+    def __init__(self, rate_per_sec: float, capacity: float):
+        if rate_per_sec <= 0:
+            raise ValueError("TokenBucket rate_per_sec must be > 0")
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+# 每個 process 每分鐘最多打幾次 chat completion（多個 gunicorn worker 要自己分配額度）
+# 設成 0（或負數）＝ 關掉 AI 回覆：不打 OpenAI，只剩 FAQ / 快取
+OPENAI_RPM = float(os.environ.get("OPENAI_RPM", "300"))
+# 等不到額度就直接回「忙線」訊息：等待時會佔住一條 webhook thread，所以只等一下下
+OPENAI_RATE_WAIT_SEC = 1
+_openai_rate_limiter = (
+    TokenBucket(OPENAI_RPM / 60.0, max(1.0, OPENAI_RPM / 60.0 * 5)) if OPENAI_RPM > 0 else None
+)
+
+# 預設 gpt-4o-mini；之後如果有針對 FAQ 微調的小模型，可以直接用環境變數換掉
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
+# 回覆會進快取重複使用，溫度壓低讓同樣的問題答案比較穩定
+OPENAI_TEMPERATURE = 0.2
+# system prompt 換版本時一起改，舊版的 prompt cache 自然就不會再被用到
+OPENAI_PROMPT_CACHE_KEY = "hr-xiaojie-v1"
+# 小潔的回覆都很短，限制輸出長度可以少掉不必要的 decode 時間與費用
+OPENAI_MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", "180"))
+# 連續空三行通常代表模型開始亂長內容，直接停掉
+OPENAI_STOP = ["\n\n\n"]
+
+
+# ✅ 很短、很單純的常見問題直接回固定答案，不用打 OpenAI
+# 答案由環境變數提供（店家資訊以店家為準），沒設定的項目就照常交給小潔回覆
+FAQ_MAX_LEN = 20
+FAQ_REPLIES = [
+    (pattern, reply)
+    for pattern, reply in (
+        (re.compile(r"營業時間|幾點開|幾點關|有營業|公休"), os.environ.get("FAQ_HOURS_REPLY", "")),
+        (re.compile(r"地址|店在哪|怎麼去|怎麼過去"), os.environ.get("FAQ_ADDRESS_REPLY", "")),
+        (re.compile(r"電話|聯絡方式"), os.environ.get("FAQ_PHONE_REPLY", "")),
     )
+    if reply
+]
+
+
+def match_faq_reply(user_text: str):
+    if len(user_text) > FAQ_MAX_LEN:
+        return None
+    for pattern, reply in FAQ_REPLIES:
+        if pattern.search(user_text):
+            return reply
+    return None
+
+
+def _log_openai_usage(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    logging.info(
+        "OpenAI usage: prompt=%s cached=%s completion=%s",
+        usage.prompt_tokens, cached_tokens, usage.completion_tokens,
+    )
+
+
+def generate_reply_from_openai(user_text: str, user_id: str = "", on_segment=None) -> str:
+    """
+    產生小潔的回覆（OpenAI 以 stream 模式回傳）。
+
+    on_segment：有給的話，串流過程中每湊滿完整的句子就呼叫 on_segment(segment)，
+    但「最後一段」不會送給 on_segment，留給呼叫端用 reply_message 回覆。
+    segment 是未 strip 的原始片段，依序串起來就是完整回覆的開頭；回傳值仍是完整回覆。
+    """
+    faq_reply = match_faq_reply(user_text)
+    if faq_reply:
+        logging.info("faq reply hit")
+        return faq_reply
+
+    client = get_openai_client()
+    if client is None or _openai_rate_limiter is None:
+        return "目前暫時無法連線到 AI 伺服器，不好意思 >_<"
+
+    # ✅ 先查快取：完全相同的問題 → 相似的問題，都命中就不用再打 chat completion
+    # 只有短訊息才查 / 才存：常見問題多半很短，長訊息通常帶著個人狀況，也順便省一次 embedding
+    cacheable = len(user_text) <= REPLY_CACHE_MAX_TEXT_LEN
+    cache_key = embedding = None
+    if cacheable:
+        cache_key = _reply_cache_key(SYSTEM_PROMPT, user_text)
+        cached = _get_exact_cached_reply(cache_key)
+        if cached:
+            logging.info("exact reply cache hit")
+            _count_reply_cache("exact")
+            return cached
+
+        embedding = _embed_text(user_text)
+        cached = _get_similar_cached_reply(embedding)
+        if cached:
+            _count_reply_cache("semantic")
+            return cached
+        _count_reply_cache("miss")
+
+    if not _openai_rate_limiter.acquire(timeout=OPENAI_RATE_WAIT_SEC):
+        logging.warning("OpenAI rate limit reached locally, skip completion")
+        return "目前系統有點忙不過來，我可能晚一點才有辦法幫你詳細回覆 QQ"
 
     try:
-        resp = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_text},
-            ],
-            temperature=0.6,
-        )
-        reply = resp.choices[0].message.content.strip()
+        parts = []
+        pending = ""  # 已經是完整句子，但還不知道後面還有沒有下一句
+        buf = ""      # 還沒湊成完整句子的尾巴
+        with _openai_semaphore:
+            stream = client.with_options(
+                max_retries=OPENAI_REPLY_MAX_RETRIES
+            ).chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[_SYSTEM_MSG, {"role": "user", "content": user_text}],
+                temperature=OPENAI_TEMPERATURE,
+                top_p=1,
+                max_tokens=OPENAI_MAX_TOKENS,
+                timeout=OPENAI_CHAT_TIMEOUT_SEC,
+                stop=OPENAI_STOP,
+                stream=True,
+                # 所有請求共用同一個 key，讓 OpenAI 把相同的 system prompt 導到同一批機器，提高 prompt cache 命中
+                # 用 extra_body 送：舊版 openai SDK 沒有 prompt_cache_key 參數，直接傳會 TypeError
+                extra_body={"prompt_cache_key": OPENAI_PROMPT_CACHE_KEY},
+                # 最後一個 chunk 會帶 usage，用來確認 system prompt 有沒有吃到 prompt caching
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    _log_openai_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if not delta:
+                    continue
+                parts.append(delta)
+                if on_segment is None:
+                    continue
+
+                buf += delta
+                cut = max(buf.rfind(ch) for ch in _SENTENCE_ENDS)
+                if cut < 0:
+                    continue
+                sentence, buf = buf[: cut + 1], buf[cut + 1:]
+                if pending.strip():
+                    on_segment(pending)
+                    pending = sentence
+                else:
+                    pending += sentence
+
+        reply = "".join(parts).strip()
+        if reply and cacheable:
+            _store_cached_reply(cache_key, embedding, reply)
         return reply or "這邊暫時想不到怎麼回，可以再多跟我描述一點嗎？"
     except Exception as e:
         logging.error("OpenAI 回覆失敗: %s", e)
@@ -269,40 +1331,66 @@ def generate_reply_from_openai(user_text: str, user_id: str = "") -> str:
 
 # ================== Booking 確認：postback → GAS 更新 Reservations.status ==================
 
-def parse_confirm_reservation_id(data: str) -> str:
+# 確認到店：postback data / 文字指令共用的前綴
+CONFIRM_PREFIX = "CONFIRM|"
+
+# 預約編號只會有英數字、- 和 _；全形字（手機輸入法常見）先轉成半形再檢查
+RESERVATION_ID_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{0,63}")
+FULLWIDTH_TABLE = str.maketrans(
+    {chr(code): chr(code - 0xFEE0) for code in range(0xFF01, 0xFF5F)}
+)
+
+
+def _clean_reservation_id(rid: str) -> str:
+    """格式不對就回傳空字串（呼叫端不用白打一次 GAS，直接回覆失敗訊息）"""
+    rid = rid.translate(FULLWIDTH_TABLE).strip()
+    if RESERVATION_ID_RE.fullmatch(rid):
+        return rid
+    if rid:
+        logging.info("invalid reservation id, ignore: %.64s", rid)
+    return ""
+
+
+def parse_confirm_reservation_id(data: str):
     """
     支援格式：
       1) CONFIRM|R-xxxx
       2) action=confirm&rid=R-xxxx
       3) JSON: {"action":"confirm","reservation_id":"R-xxxx"}
+
+    回傳：
+      None → 不是確認到店的資料（其他功能的 postback / 一般文字）
+      ""   → 是確認到店，但預約編號格式不對（不打 GAS，照樣回覆失敗訊息）
     """
     if not data:
-        return ""
+        return None
 
     s = data.strip()
 
-    if s.startswith("CONFIRM|"):
-        return s.split("|", 1)[1].strip()
-
-    # querystring style
-    if "rid=" in s or "reservation_id=" in s:
-        try:
-            qs = urllib.parse.parse_qs(s, keep_blank_values=True)
-            rid = (qs.get("rid") or qs.get("reservation_id") or [""])[0]
-            return (rid or "").strip()
-        except Exception:
-            pass
+    # ✅ 最常見的格式先判斷，其他格式看第一個字 / 有沒有 "=" 再決定要不要解析
+    if s.startswith(CONFIRM_PREFIX):
+        return _clean_reservation_id(s[len(CONFIRM_PREFIX):])
 
     # json
-    try:
-        obj = json.loads(s)
-        if isinstance(obj, dict):
+    if s[:1] == "{":
+        try:
+            obj = loads_json(s)
+        except ValueError:
+            return None
+        if isinstance(obj, dict) and ("rid" in obj or "reservation_id" in obj):
             rid = obj.get("rid") or obj.get("reservation_id") or ""
-            return str(rid).strip()
-    except Exception:
-        pass
+            return _clean_reservation_id(str(rid))
+        return None
 
-    return ""
+    # querystring style
+    if "rid=" in s or "reservation_id=" in s:
+        qs = urllib.parse.parse_qs(s, keep_blank_values=True)
+        if "rid" not in qs and "reservation_id" not in qs:
+            return None
+        rid = (qs.get("rid") or qs.get("reservation_id") or [""])[0]
+        return _clean_reservation_id(rid or "")
+
+    return None
 
 
 def confirm_booking_in_gas(reservation_id: str, line_user_id: str):
@@ -322,11 +1410,16 @@ def confirm_booking_in_gas(reservation_id: str, line_user_id: str):
     }
 
     try:
-        resp = requests.post(GAS_BOOKING_URL, json=payload, timeout=8)
+        resp = GAS_SESSION.post(
+            GAS_BOOKING_URL,
+            data=dumps_json_bytes(payload),
+            headers=JSON_HEADERS,
+            timeout=8,
+        )
         text = resp.text or ""
         logging.info("confirm_booking_in_gas status=%s body=%s", resp.status_code, text[:200])
         try:
-            data = resp.json()
+            data = loads_json(resp.content)
             if isinstance(data, dict):
                 return data
         except Exception:
@@ -336,27 +1429,87 @@ def confirm_booking_in_gas(reservation_id: str, line_user_id: str):
         return {"ok": False, "error": "GAS_REQUEST_FAILED", "message": str(e)}
 
 
+# ✅ bubble 裡只有預約編號會變：標題兩種版本跟說明文字啟動時就先建好
+# （SDK 只會讀這些 dict 來建立 FlexSendMessage，不會修改，可以共用）
+_CONFIRMED_FLEX_TITLES = {
+    False: {"type": "text", "text": "確認會到店", "weight": "bold", "size": "lg"},
+    True: {"type": "text", "text": "已確認過了", "weight": "bold", "size": "lg"},
+}
+_CONFIRMED_FLEX_BODY_TEMPLATE = "預約編號：{}\n收到～若需要改期或取消，直接跟我們說一聲就好。"
+
+
 def make_confirmed_flex(reservation_id: str, already: bool = False):
-    title = "確認會到店" if not already else "已確認過了"
-    body_lines = [
-        f"預約編號：{reservation_id}",
-        "收到～若需要改期或取消，直接跟我們說一聲就好。",
-    ]
     return {
         "type": "bubble",
         "body": {
             "type": "box",
             "layout": "vertical",
             "contents": [
-                {"type": "text", "text": title, "weight": "bold", "size": "lg"},
-                {"type": "text", "text": "\n".join(body_lines), "margin": "md", "wrap": True},
+                _CONFIRMED_FLEX_TITLES[bool(already)],
+                {
+                    "type": "text",
+                    "text": _CONFIRMED_FLEX_BODY_TEMPLATE.format(reservation_id),
+                    "margin": "md",
+                    "wrap": True,
+                },
             ],
         },
     }
 
 
+# ================== 回覆：reply_token 失效時改用 push ==================
+
+def _is_invalid_reply_token_error(e: LineBotApiError) -> bool:
+    """LINE 回 400 "Invalid reply token"：reply_token 已過期或已經用過"""
+    message = getattr(e.error, "message", "") or ""
+    return e.status_code == 400 and "reply token" in message.lower()
+
+
+def reply_or_push(reply_token: str, user_id: str, messages):
+    """
+    先用 reply_message（不算訊息額度）；
+    事件在背景處理太久、reply_token 已失效被 LINE 拒絕時，改用 push_message 補送。
+    其他錯誤（429、5xx、訊息格式錯誤…）照樣丟出去：push 也不會成功，
+    5xx 時訊息還可能其實已經送達，重送會變成重複訊息又白花 push 額度。
+    """
+    try:
+        line_bot_api.reply_message(reply_token, messages)
+        return
+    except LineBotApiError as e:
+        if not user_id or not _is_invalid_reply_token_error(e):
+            raise
+        logging.warning("reply_token 已失效，改用 push_message: %s", e)
+    line_bot_api.push_message(user_id, messages)
+
+
 # ================== LINE Webhook 入口 ==================
 
+# ✅ 驗完簽章就先回 200 給 LINE，事件（GAS / OpenAI / 回覆）交給背景 thread 處理
+_webhook_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+
+
+def _handle_webhook_body(body: str, signature: str):
+    try:
+        handler.handle(body, signature)
+    except Exception as e:
+        logging.exception("handle webhook error: %s", e)
+
+
+def verify_line_signature(raw: bytes, signature: str) -> bool:
+    """
+    用 channel secret 對 webhook 原始 bytes 算 HMAC-SHA256，
+    跟 X-Line-Signature（base64）做 constant-time 比對。
+    """
+    if len(signature) != LINE_SIGNATURE_LEN:
+        return False
+    try:
+        expected = base64.b64decode(signature, validate=True)
+    except Exception:
+        return False
+    digest = hmac.new(CHANNEL_SECRET_BYTES, raw, hashlib.sha256).digest()
+    return hmac.compare_digest(digest, expected)
+
+
 @app.route("/api/ping", methods=["GET"])
 def api_ping():
     return {
@@ -371,15 +1524,33 @@ def api_ping():
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
-    body = request.get_data(as_text=True)
-    logging.info("Request body (head200): %s", body[:200])
+    # 沒帶簽章或長度不對（掃描 / 亂打的請求），連 body 都不用讀
+    if len(signature) != LINE_SIGNATURE_LEN:
+        logging.warning("Missing or malformed X-Line-Signature, reject.")
+        abort(400)
 
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    # ✅ 沒有 body 或 body 大得不合理，也在讀取之前就擋掉（慢速連線不會卡住 worker）
+    content_length = request.content_length
+    if not content_length or content_length > WEBHOOK_MAX_BODY_BYTES:
+        logging.warning("Unexpected webhook Content-Length: %s, reject.", content_length)
+        abort(400)
+
+    raw = request.get_data(cache=False, parse_form_data=False)
+
+    # ✅ 直接對原始 bytes 驗簽，簽章不對就不用 decode / parse JSON
+    if not verify_line_signature(raw, signature):
         logging.error("Invalid signature. Check channel access token/secret.")
         abort(400)
 
+    body = raw.decode("utf-8")
+    if LOG_FULL_BODY:
+        logging.info("Request body (len=%d): %s", len(body), body)
+    else:
+        logging.info("Webhook received (len=%d)", len(body))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Request body: %.200s", body)
+
+    _webhook_executor.submit(_handle_webhook_body, body, signature)
     return "OK"
 
 
@@ -387,6 +1558,9 @@ def callback():
 
 @handler.add(PostbackEvent)
 def handle_postback(event):
+    if is_redelivered_event(event):
+        return
+
     user_id = ""
     try:
         user_id = event.source.user_id
@@ -403,12 +1577,15 @@ def handle_postback(event):
     log_postback_event(user_id, data, sender="user")
 
     rid = parse_confirm_reservation_id(data)
-    if not rid:
+    if rid is None:
         # 不是我們要的 postback，就略過（避免影響你其他功能）
         return
 
-    # ✅ 呼叫 GAS 更新 Reservations
-    res = confirm_booking_in_gas(rid, user_id)
+    # ✅ 呼叫 GAS 更新 Reservations（預約編號格式不對就不打 GAS，直接走失敗回覆）
+    if rid:
+        res = confirm_booking_in_gas(rid, user_id)
+    else:
+        res = {"ok": False, "error": "invalid reservation id"}
 
     if res.get("ok") is True:
         already = bool(res.get("alreadyConfirmed"))
@@ -423,12 +1600,13 @@ def handle_postback(event):
         )
 
         try:
-            line_bot_api.reply_message(
+            reply_or_push(
                 event.reply_token,
+                user_id,
                 [
-                    text="收到，我已幫您把這筆預約標記為「確認會到店」。",
-                        sender=Sender(name="小潔 H.R 燈藝客服"),
-                        text="
+                    TextSendMessage(
+                        text="收到，我已幫您把這筆預約標記為「確認會到店」。",
+                        sender=XIAOJIE_SENDER,
                     ),
                     flex,
                 ],
@@ -440,39 +1618,173 @@ def handle_postback(event):
     # ✅ 失敗也要回覆（讓你知道 webhook 有進來）
     logging.error("confirm_booking_in_gas failed: %s", res)
     try:
-        line_bot_api.reply_message(
+        reply_or_push(
             event.reply_token,
+            user_id,
             TextSendMessage(
                 text="我有收到您的確認，但系統更新狀態時出了點狀況。麻煩您直接回覆我們『已確認到店』，我會請客服幫您處理。",
-                sender=Sender(name="小潔 H.R 燈藝客服"),
+                sender=XIAOJIE_SENDER,
             ),
         )
     except Exception as e:
         logging.error("reply postback failed failed: %s", e)
 
 
+# ================== 事件處理：文字 / 貼圖共用的自動回覆流程 ==================
+
+STICKER_REPLY_TEXT = "收到你的貼圖～如果方便的話，也可以再打一點文字，讓小潔更好幫你喔！"
+_EVENT_KIND_LABELS = {"text": "文字訊息", "sticker": "貼圖訊息"}
+
+
+def auto_reply_event(event, kind: str, build_reply, ts_iso: str, user_log_body=None):
+    """
+    文字 / 貼圖訊息共用的流程：
+      1) LINE 後台 Verify 送來的假 reply_token、太舊的事件 → 不查 routing、直接略過
+      2) 查 routing，決定這一則要不要由小潔自動回覆
+         （user_log_body：還沒記錄的使用者訊息，交給 get_routing_for_turn 一起處理）
+      3) build_reply() 產生回覆，回傳 (完整回覆, 要用 reply_message 送出的文字)
+      4) 先把 bot 訊息排進 log queue（帶 persona），再回覆
+    """
+    user_id = event.source.user_id
+    reply_token = event.reply_token
+    label = _EVENT_KIND_LABELS.get(kind, kind)
+
+    if reply_token in INVALID_REPLY_TOKENS:
+        logging.info("跳過假 reply_token，不回覆%s。", label)
+        if user_log_body is not None:
+            log_to_gas(user_log_body)
+        return
+
+    # ✅ 先看事件新不新：超過 EVENT_FRESHNESS_MS 一定不會自動回覆，就不用再打 GAS 查 routing
+    # （還沒記錄的使用者訊息 user_log_body 在這裡直接排進 log queue）
+    event_ms = getattr(event, "timestamp", None)
+    now_ms = current_ms()
+    if isinstance(event_ms, (int, float)) and now_ms - event_ms > EVENT_FRESHNESS_MS:
+        logging.info(
+            "event too old to auto-reply, skip routing: delta_ms=%s (%s)", now_ms - event_ms, label
+        )
+        if user_log_body is not None:
+            log_to_gas(user_log_body)
+        return
+
+    bot_mode, owner_agent_id, last_mode_at_ms = get_routing_for_turn(
+        user_id, user_log_body, event_timestamp_ms=event_ms
+    )
+    should_reply = should_auto_reply_text(bot_mode, event_ms, last_mode_at_ms, now_ms=now_ms)
+
+    # 模式是在這則訊息之後才切換的：快取的 routing 可能馬上又會變，清掉讓下一則重新查
+    if (
+        isinstance(event_ms, int)
+        and isinstance(last_mode_at_ms, int)
+        and event_ms < last_mode_at_ms
+    ):
+        invalidate_cached_routing(user_id)
+
+    reply_text, send_text = (None, None)
+    if should_reply:
+        reply_text, send_text = build_reply()
+
+    if reply_text:
+        log_from_event(
+            event,
+            msg_type="text",
+            text=reply_text,
+            sender="bot",
+            display_persona="xiaojie",
+            ts_iso=ts_iso,
+        )
+
+    if send_text:
+        try:
+            reply_or_push(
+                reply_token,
+                user_id,
+                TextSendMessage(
+                    text=send_text,
+                    sender=XIAOJIE_SENDER,
+                ),
+            )
+        except Exception as e:
+            logging.error("回覆%s失敗: %s", label, e)
+    else:
+        logging.info(
+            "%s: bot_mode=%s last_mode_at_ms=%s event_ms=%s should_reply=%s",
+            kind, bot_mode, last_mode_at_ms, event_ms, should_reply
+        )
+
+
 # ================== 事件處理：文字訊息 ==================
 
+# ✅ 同一個使用者一次只處理一則文字訊息（一個 turn）：
+# 上一句還在等 OpenAI 時，新的 turn 先排進這個使用者的 pending，webhook thread 直接放掉；
+# 正在跑的 thread 做完後，接著依序處理 pending（每一則都會回覆，reply_token 過期就用 push）。
+# 一個人連發好幾句，也只會佔住一條 webhook thread。
+_user_turns = {}  # user_id -> 還沒處理的 turn（list；key 存在代表這個使用者有 turn 正在跑）
+_user_turns_lock = threading.Lock()
+
+
+def run_user_turn(user_id: str, turn):
+    """
+    執行 turn()；同一個 user_id 的 turn 依到達順序一個一個跑，不會同時跑兩個。
+    前一個 turn 還沒結束時只排隊、馬上返回，由正在跑的 thread 接手。
+    """
+    if not user_id:
+        turn()
+        return
+
+    with _user_turns_lock:
+        pending = _user_turns.get(user_id)
+        if pending is not None:
+            pending.append(turn)
+            logging.info("previous turn for %s still running, queued (%d pending)", user_id, len(pending))
+            return
+        _user_turns[user_id] = []
+
+    while True:
+        try:
+            turn()
+        except Exception as e:
+            logging.exception("user turn error: %s", e)
+        with _user_turns_lock:
+            pending = _user_turns[user_id]
+            if not pending:
+                del _user_turns[user_id]
+                return
+            turn = pending.pop(0)
+
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
+    if is_redelivered_event(event):
+        return
+
     user_text = event.message.text
     user_id = event.source.user_id
+    ts_iso = event_ts_iso(event)
 
-    # 0) 先記錄「使用者這句話」（不管是不是自動小潔）
-    log_from_event(
+    # 0) 記錄「使用者這句話」（不管是不是自動小潔）
+    # 一般訊息交給 auto_reply_event，可以跟 routing 查詢合併成一次 GAS 呼叫
+    user_log_body = build_log_body(
         event,
         msg_type="text",
         text=user_text,
         sender="user",
+        ts_iso=ts_iso,
     )
 
-    
     # ✅ 支援使用文字指令確認到店（避免 postback 沒進 webhook 時無反應）
     # 按鈕若改成 message: "CONFIRM|R-xxxx" 也能更新狀態 + 第2次靜默
-    if isinstance(user_text, str) and user_text.strip().startswith("CONFIRM|"):
+    if isinstance(user_text, str) and user_text.strip().startswith(CONFIRM_PREFIX):
+        if user_log_body is not None:
+            log_to_gas(user_log_body)
+            user_log_body = None
         rid = parse_confirm_reservation_id(user_text.strip())
-        if rid:
-            res = confirm_booking_in_gas(rid, user_id)
+        if rid is not None:
+            # 預約編號格式不對就不打 GAS，直接走失敗回覆
+            if rid:
+                res = confirm_booking_in_gas(rid, user_id)
+            else:
+                res = {"ok": False, "error": "invalid reservation id"}
             if res.get("ok") is True:
                 if bool(res.get("alreadyConfirmed")):
                     return
@@ -481,12 +1793,13 @@ def handle_text_message(event):
                     contents=make_confirmed_flex(rid, already=False)
                 )
                 try:
-                    line_bot_api.reply_message(
+                    reply_or_push(
                         event.reply_token,
+                        user_id,
                         [
                             TextSendMessage(
                                 text="收到，我已幫您把這筆預約標記為「確認會到店」。",
-                                sender=Sender(name="小潔 H.R 燈藝客服"),
+                                sender=XIAOJIE_SENDER,
                             ),
                             flex,
                         ],
@@ -496,114 +1809,72 @@ def handle_text_message(event):
                 return
             else:
                 try:
-                    line_bot_api.reply_message(
+                    reply_or_push(
                         event.reply_token,
+                        user_id,
                         TextSendMessage(
                             text="我有收到您的確認，但系統更新狀態時出了點狀況。麻煩您直接回覆我們『已確認到店』，我會請客服幫您處理。",
-                            sender=Sender(name="小潔 H.R 燈藝客服"),
+                            sender=XIAOJIE_SENDER,
                         ),
                     )
                 except Exception as e:
                     logging.error("reply CONFIRM text failed failed: %s", e)
                 return
 
-    # 1) 查 routing
-    bot_mode, owner_agent_id, last_mode_at_ms = get_line_user_routing(user_id)
-    event_ms = getattr(event, "timestamp", None)
-
-    # 2) 決定是否自動回覆
-    should_reply = should_auto_reply_text(bot_mode, event_ms, last_mode_at_ms)
-
-    reply_text = None
-    if should_reply:
-        reply_text = generate_reply_from_openai(user_text, user_id=user_id)
-
-    reply_token = event.reply_token
-    invalid_tokens = {
-        "00000000000000000000000000000000",
-        "ffffffffffffffffffffffffffffffff",
-    }
+    # 1) 查 routing → 2) 決定是否自動回覆 → 3) 產生小潔回覆 + 記錄，由 auto_reply_event 處理
+    #    這裡只負責「怎麼產生回覆」：OpenAI（STREAM_PUSH_REPLY 時邊產生邊 push）
+    def build_reply():
+        pushed = []
 
-    if reply_text and reply_token not in invalid_tokens:
-        try:
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(
-                    text=reply_text,
-                    sender=Sender(
-                        name="小潔 H.R 燈藝客服",
+        def push_segment(segment):
+            # push 失敗一次就不再 push，剩下的全部交給 reply_message
+            if pushed and pushed[-1] is None:
+                return
+            try:
+                line_bot_api.push_message(
+                    user_id,
+                    TextSendMessage(
+                        text=segment.strip(),
+                        sender=XIAOJIE_SENDER,
                     ),
-                ),
-            )
-        except Exception as e:
-            logging.error("回覆文字訊息失敗: %s", e)
-    else:
-        if reply_token in invalid_tokens:
-            logging.info("跳過假 reply_token，不回覆文字訊息。")
-        else:
-            logging.info(
-                "text: bot_mode=%s last_mode_at_ms=%s event_ms=%s should_reply=%s",
-                bot_mode, last_mode_at_ms, event_ms, should_reply
-            )
-
-    # 3) 如果真的有產生小潔回覆，再額外記錄一筆 bot 訊息（帶 persona）
-    if reply_text:
-        log_from_event(
-            event,
-            msg_type="text",
-            text=reply_text,
-            sender="bot",
-            display_persona="xiaojie",
+                )
+                pushed.append(segment)
+            except Exception as e:
+                logging.error("push 串流片段失敗: %s", e)
+                pushed.append(None)
+
+        reply_text = generate_reply_from_openai(
+            user_text,
+            user_id=user_id,
+            on_segment=push_segment if STREAM_PUSH_REPLY else None,
         )
 
+        # 已經 push 出去的句子不要重複回覆
+        remaining_text = reply_text
+        pushed_prefix = "".join(seg for seg in pushed if seg is not None).lstrip()
+        if reply_text and pushed_prefix and reply_text.startswith(pushed_prefix):
+            remaining_text = reply_text[len(pushed_prefix):].strip()
+        return reply_text, remaining_text
+
+    # 排隊等前一句的期間，事件可能變舊：auto_reply_event 執行時才判斷新不新，太舊就只記錄不回覆
+    run_user_turn(
+        user_id,
+        lambda: auto_reply_event(event, "text", build_reply, ts_iso, user_log_body=user_log_body),
+    )
+
 
 # ================== 事件處理：貼圖訊息 ==================
 
 @handler.add(MessageEvent, message=StickerMessage)
 def handle_sticker_message(event):
+    if is_redelivered_event(event):
+        return
+
     package_id = event.message.package_id
     sticker_id = event.message.sticker_id
-    user_id = event.source.user_id
-
-    # 先查 routing
-    bot_mode, owner_agent_id, last_mode_at_ms = get_line_user_routing(user_id)
-    event_ms = getattr(event, "timestamp", None)
+    ts_iso = event_ts_iso(event)
 
-    should_reply = should_auto_reply_text(bot_mode, event_ms, last_mode_at_ms)
-
-    reply_text = None
-    if should_reply:
-        reply_text = "收到你的貼圖～如果方便的話，也可以再打一點文字，讓小潔更好幫你喔！"
-
-    reply_token = event.reply_token
-    invalid_tokens = {
-        "00000000000000000000000000000000",
-        "ffffffffffffffffffffffffffffffff",
-    }
-
-    if reply_text and reply_token not in invalid_tokens:
-        try:
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(
-                    text=reply_text,
-                    sender=Sender(
-                        name="小潔 H.R 燈藝客服",
-                    ),
-                ),
-            )
-        except Exception as e:
-            logging.error("回覆貼圖訊息失敗: %s", e)
-    else:
-        if reply_token in invalid_tokens:
-            logging.info("跳過假 reply_token，不回覆貼圖訊息。")
-        else:
-            logging.info(
-                "sticker: bot_mode=%s last_mode_at_ms=%s event_ms=%s should_reply=%s",
-                bot_mode, last_mode_at_ms, event_ms, should_reply
-            )
-
-    # 記錄使用者這張貼圖
+    # 記錄使用者這張貼圖（只是進 queue，不會卡住後面的 routing 查詢）
     log_from_event(
         event,
         msg_type="sticker",
@@ -611,23 +1882,24 @@ def handle_sticker_message(event):
         sticker_package_id=package_id,
         sticker_id=sticker_id,
         sender="user",
+        ts_iso=ts_iso,
     )
 
-    # 如果有回覆文字，再記錄一筆 bot 訊息（帶 persona）
-    if reply_text:
-        log_from_event(
-            event,
-            msg_type="text",
-            text=reply_text,
-            sender="bot",
-            display_persona="xiaojie",
-        )
+    auto_reply_event(
+        event,
+        "sticker",
+        lambda: (STICKER_REPLY_TEXT, STICKER_REPLY_TEXT),
+        ts_iso,
+    )
 
 
 # ================== 主程式啟動 ==================
 
+# 正式環境請用 gunicorn 啟動（設定見 gunicorn.conf.py）：
+#   gunicorn main:app
+# 下面的 app.run 只給本機開發用
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     logging.info("Booting... port=%s has_gas_booking_url=%s", port, bool(GAS_BOOKING_URL))
-    app.run(host="0.0.0.0", port=port)
+    app.run(host="0.0.0.0", port=port, threaded=True)
 